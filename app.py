@@ -1,8 +1,12 @@
-from flask import Flask
+from flask import Flask, request
+import asyncio
+import atexit
 import threading
 import logging
 import time
 import sys
+import os
+import filelock
 app = Flask(__name__)
 # Configure logging to show in PythonAnywhere logs
 logging.basicConfig(
@@ -25,28 +29,114 @@ def health():
     return "✅ OK", 200
 
 
-@app.route('/start')
-def run_bot():
-    """Run the bot with polling"""
+@app.route('/webhook', methods=['POST'])
+def webhook():
+    """Hand an update pushed by Telegram to the bot's update queue"""
+    if bot_application is None:
+        return "❌ Bot is not running", 503
+    from bot import WEBHOOK_SECRET
+    from telegram import Update
+    if WEBHOOK_SECRET and request.headers.get(
+            'X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET:
+        return "❌ Forbidden", 403
+    update = Update.de_json(request.get_json(force=True), bot_application.bot)
+    asyncio.run_coroutine_threadsafe(
+        bot_application.update_queue.put(update), bot_loop)
+    return "✅ OK", 200
+
+
+def run_webhook_bot():
+    """Start the bot in webhook mode on its own event loop, retrying until it is up"""
+    global bot_application, bot_loop
+    while True:
+        loop = asyncio.new_event_loop()
+        application = None
+        try:
+            # Import inside function to avoid circular imports
+            from bot import build_application, start_webhook
+            application = build_application()
+            loop.run_until_complete(start_webhook(application))
+        except Exception:
+            logger.exception("❌ Failed to start bot webhook")
+            if application is not None:
+                from bot import stop_webhook, save_unwritten
+                try:
+                    loop.run_until_complete(stop_webhook(application))
+                    save_unwritten()
+                except Exception:
+                    logger.exception("❌ Failed to clean up bot webhook")
+            loop.close()
+            logger.info("🔄 Retrying in 30 seconds...")
+            time.sleep(30)
+            continue
+        bot_application, bot_loop = application, loop
+        logger.info("✅ Bot webhook started successfully")
+        # The loop only processes queued updates; nothing polls Telegram
+        loop.run_forever()
+        return
+
+
+def stop_webhook_bot():
+    """Stop the webhook bot and save its queued transactions before exit"""
+    if bot_application is None:
+        return
+    from bot import stop_webhook, save_unwritten
+    logger.info("🛑 Stopping bot webhook...")
     try:
-        # Import inside function to avoid circular imports
-        from bot import main as bot_main
-        logger.info("🚀 Starting Telegram bot with polling...")
-        bot_main()  # This runs application.run_polling()
-    except Exception as e:
-        logger.error(f"❌ Bot crashed: {e}")
-        logger.info("🔄 Restarting bot in 30 seconds...")
-        time.sleep(30)
-        run_bot()  # Auto-restart
+        asyncio.run_coroutine_threadsafe(
+            stop_webhook(bot_application), bot_loop).result(timeout=60)
+    except Exception:
+        logger.exception("❌ Failed to stop bot webhook cleanly")
+    else:
+        # Thread pools are already shut down when atexit hooks run, so the
+        # loop cannot write through asyncio.to_thread; write from here
+        save_unwritten()
+    bot_loop.call_soon_threadsafe(bot_loop.stop)
+
+
+def run_bot():
+    """Run the bot with polling, restarting it after a crash"""
+    while True:
+        try:
+            # Import inside function to avoid circular imports
+            from bot import main as bot_main
+            logger.info("🚀 Starting Telegram bot with polling...")
+            # Worker threads have no event loop; run_polling closes the
+            # loop when it returns, so every attempt needs a new one
+            asyncio.set_event_loop(asyncio.new_event_loop())
+            bot_main(stop_signals=None)  # This runs application.run_polling()
+            return
+        except Exception:
+            logger.exception("❌ Bot crashed")
+            logger.info("🔄 Restarting bot in 30 seconds...")
+            time.sleep(30)
 
 
 # Start bot when module loads
-try:
-    logger.info("📦 Initializing bot thread...")
-    bot_thread = threading.Thread(target=run_bot, daemon=True)
-    bot_thread.start()
-    logger.info("✅ Bot thread started successfully")
-except Exception as e:
-    logger.error(f"❌ Failed to start bot thread: {e}")
+bot_application = None
+bot_loop = None
+if os.environ.get('WEBHOOK_URL'):
+    try:
+        logger.info("📦 Initializing bot webhook...")
+        threading.Thread(target=run_webhook_bot, daemon=True).start()
+        # Runs on normal interpreter exit, including gunicorn's SIGTERM
+        # handling, so queued transactions are written before the loop dies
+        atexit.register(stop_webhook_bot)
+    except Exception as e:
+        logger.error(f"❌ Failed to start bot webhook: {e}")
+else:
+    # Only one process may poll Telegram, otherwise getUpdates fails with
+    # 409 Conflict; the lock is held for the lifetime of the winning worker
+    _bot_lock = filelock.FileLock('/tmp/bot.lock')
+    try:
+        _bot_lock.acquire(timeout=0)
+        logger.info("📦 Initializing bot thread...")
+        bot_thread = threading.Thread(target=run_bot, daemon=True)
+        bot_thread.start()
+        logger.info("✅ Bot thread started successfully")
+    except filelock.Timeout:
+        logger.info("ℹ️ Bot already running in another worker")
+    except Exception as e:
+        logger.error(f"❌ Failed to start bot thread: {e}")
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000)
@@ -2,11 +2,18 @@ import logging
 import re
 import os
 import json
+import time
+import asyncio
+import functools
+import threading
 import gspread
 from datetime import datetime, date
 from telegram import Update
 from telegram.ext import Application, MessageHandler, filters, ContextTypes
 from google.oauth2.service_account import Credentials
+from google.auth.transport.requests import AuthorizedSession
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 # Enhanced logging for cloud
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -18,60 +25,121 @@ logger = logging.getLogger(__name__)
 BOT_TOKEN = os.environ.get('BOT_TOKEN')
 SPREADSHEET_NAME = os.environ.get(
     'SPREADSHEET_NAME', 'Personal Finance Tracker')
+# Public HTTPS URL of the Flask /webhook route; when unset the bot uses polling
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL')
+# Optional secret Telegram echoes back in the X-Telegram-Bot-Api-Secret-Token header
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET')
+# How long (seconds) the in-memory daily totals are trusted before the sheet
+# is re-read to pick up edits made directly in Google Sheets
+CACHE_TTL = 300
+# Hidden worksheet holding one SUMIF formula per user for today's total
+DAILY_AGG_SHEET = 'DailyAgg'
+# Each user's transactions live in their own worksheet named after the user ID
+USER_SHEET_HEADERS = ['Date', 'Amount', 'Description', 'Username']
+# Amounts are stored as numbers and only displayed as Rupiah
+AMOUNT_FORMAT = {'numberFormat': {'type': 'NUMBER', 'pattern': '"Rp"#,##0'}}
+# Rows a new user sheet starts with; appends add more as needed
+USER_SHEET_ROWS = 1000
+# Transactions are written in batches of up to BATCH_MAX_ROWS rows, flushed
+# BATCH_INTERVAL seconds after the first queued row
+BATCH_MAX_ROWS = 50
+BATCH_INTERVAL = 1.0
+# Sheets allows 100 requests per 100 seconds; cap concurrent calls and back
+# off exponentially when the API answers 429
+SHEETS_CONCURRENCY = 5
+SHEETS_MAX_RETRIES = 5
+MAX_BACKOFF = 60
+# After this many failed attempts a batch is written one user at a time
+SPLIT_AFTER_FAILURES = 3
+# Number with an optional known multiplier, e.g. "25000", "2rb", "2 rb",
+# "2jt", "2 jt", "2k", "2 k", "25rbmakan". "rb" and "jt" may run into the
+# next word; the single letters k/m/b only count when no letter follows,
+# so "2makan", "2kg" and "2buah" keep their plain number
+_NUM_MULT_RE = re.compile(
+    r'(\d+(?:\.\d+)?)(?:\s*(rb|jt)|\s*(k|m|b)(?![a-z]))?')
+_WS_RE = re.compile(r'\s+')
+# First row number of an A1 range such as "DailyAgg!A5:B5"
+_RANGE_ROW_RE = re.compile(r'![A-Z]+(\d+)')
+
+
+@functools.lru_cache(maxsize=1)
+def _load_creds():
+    """Load the scoped service account credentials once per process"""
+    try:
+        # Try to use credentials file first
+        if os.path.exists('credentials.json'):
+            logger.info("✅ Using credentials.json file")
+            creds = Credentials.from_service_account_file('credentials.json')
+        else:
+            # Fallback to environment variable (if you want to keep both options)
+            credentials_json = os.environ.get('GOOGLE_CREDENTIALS_JSON')
+            if credentials_json:
+                logger.info("✅ Using environment variable")
+                creds_dict = json.loads(credentials_json)
+                creds = Credentials.from_service_account_info(creds_dict)
+            else:
+                raise FileNotFoundError(
+                    "No credentials found - please add credentials.json file")
+    except Exception as e:
+        logger.error(f"❌ Error getting credentials: {e}")
+        raise
+    scope = [
+        "https://spreadsheets.google.com/feeds",
+        "https://www.googleapis.com/auth/drive"
+    ]
+    return creds.with_scopes(scope)
+
+
+def _cell(value):
+    """Cell data for appendCells; strings stay text like a RAW write"""
+    if isinstance(value, (int, float)):
+        return {'userEnteredValue': {'numberValue': value}}
+    return {'userEnteredValue': {'stringValue': str(value)}}
 
 
 class GoogleSheetsFinanceTracker:
     def __init__(self):
-        self.sheet = None
+        self.spreadsheet = None
+        self.agg_sheet = None
         self.client = None
+        # user_id -> row of that user's formula in the DailyAgg sheet
+        self._agg_rows = {}
+        # user_id -> that user's transactions worksheet
+        self._user_sheets = {}
+        # Date currently summed by the DailyAgg formulas
+        self._agg_date = None
+        # (user_id, 'YYYY-MM-DD') -> total spent that day
+        self._daily_totals = {}
+        self._cache_loaded_at = 0.0
+        # Amounts counted in _daily_totals but not yet written to the sheet
+        self._pending = {}
+        self._cache_lock = threading.Lock()
         self.setup_sheets()
 
-    def get_credentials(self):
-        try:
-            # Try to use credentials file first
-            if os.path.exists('credentials.json'):
-                logger.info("✅ Using credentials.json file")
-                return Credentials.from_service_account_file('credentials.json')
-            else:
-                # Fallback to environment variable (if you want to keep both options)
-                credentials_json = os.environ.get('GOOGLE_CREDENTIALS_JSON')
-                if credentials_json:
-                    logger.info("✅ Using environment variable")
-                    creds_dict = json.loads(credentials_json)
-                    return Credentials.from_service_account_info(creds_dict)
-                else:
-                    raise FileNotFoundError(
-                        "No credentials found - please add credentials.json file")
-        except Exception as e:
-            logger.error(f"❌ Error getting credentials: {e}")
-            raise
-
     def setup_sheets(self):
         """Setup Google Sheets connection"""
         try:
-            creds = self.get_credentials()
-
-            scope = [
-                "https://spreadsheets.google.com/feeds",
-                "https://www.googleapis.com/auth/drive"
-            ]
-
-            scoped_creds = creds.with_scopes(scope)
-            self.client = gspread.authorize(scoped_creds)
+            scoped_creds = _load_creds()
+            # One pooled keep-alive session so each API call reuses an open
+            # TLS connection; only idempotent requests are retried
+            session = AuthorizedSession(scoped_creds)
+            session.mount('https://', HTTPAdapter(
+                pool_connections=4, pool_maxsize=16,
+                max_retries=Retry(total=3, backoff_factor=0.5,
+                                  status_forcelist=(500, 502, 503, 504))))
+            self.client = gspread.Client(auth=scoped_creds, session=session)
             logger.info("✅ Successfully authorized with Google Sheets API")
 
             try:
-                self.sheet = self.client.open(SPREADSHEET_NAME).sheet1
+                self.spreadsheet = self.client.open(SPREADSHEET_NAME)
                 logger.info(
                     f"✅ Successfully opened spreadsheet: {SPREADSHEET_NAME}")
             except gspread.SpreadsheetNotFound:
                 logger.error(f"❌ Spreadsheet '{SPREADSHEET_NAME}' not found!")
                 self.create_new_spreadsheet()
 
-            if not self.sheet.get_all_records():
-                self.sheet.append_row(
-                    ['Date', 'Amount', 'Description', 'UserID', 'Username'])
-                logger.info("✅ Added headers to sheet")
+            self.setup_daily_agg()
+            self._load_daily_totals()
 
         except Exception as e:
             logger.error(f"❌ Error setting up Google Sheets: {e}")
@@ -81,95 +149,263 @@ class GoogleSheetsFinanceTracker:
         """Create a new spreadsheet if it doesn't exist"""
         try:
             # Create new spreadsheet
-            new_spreadsheet = self.client.create(SPREADSHEET_NAME)
-            self.sheet = new_spreadsheet.sheet1
+            self.spreadsheet = self.client.create(SPREADSHEET_NAME)
             logger.info(f"✅ Created new spreadsheet: {SPREADSHEET_NAME}")
-            # Add headers
-            self.sheet.append_row(
-                ['Date', 'Amount', 'Description', 'UserID', 'Username'])
-            logger.info("✅ Added headers to new spreadsheet")
         except Exception as e:
             logger.error(f"❌ Failed to create new spreadsheet: {e}")
             raise
 
-    def add_transaction(self, amount, description, user_id, username):
-        """Add transaction to Google Sheets"""
+    def setup_daily_agg(self):
+        """Open or create the hidden sheet that sums today's spending per user
+
+        Column A holds the user ID and column B a SUMIF over that user's
+        worksheet, so reading today's totals downloads one cell per user
+        instead of the whole transaction history. B1 holds the date being
+        summed.
+        """
         try:
-            today = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            self.sheet.append_row([
-                today,
-                amount,
-                description,
-                user_id,
-                username
-            ])
-            logger.info(f"✅ Added: Rp{amount:,.0f} - {description}")
-            return True
-        except Exception as e:
-            logger.error(f"❌ Error adding transaction: {e}")
-            return False
+            self.agg_sheet = self.spreadsheet.worksheet(DAILY_AGG_SHEET)
+        except gspread.WorksheetNotFound:
+            self.agg_sheet = self.spreadsheet.add_worksheet(
+                DAILY_AGG_SHEET, rows=100, cols=2)
+            self.agg_sheet.update('A1', [['UserID']])
+            self.agg_sheet.hide()
+            logger.info(f"✅ Created {DAILY_AGG_SHEET} sheet")
+        self._load_agg_rows()
+
+    def _load_agg_rows(self):
+        """Read which DailyAgg row belongs to which user from column A"""
+        user_ids = self.agg_sheet.col_values(
+            1, value_render_option='UNFORMATTED_VALUE')
+        self._agg_rows = {
+            str(uid): row for row, uid in enumerate(user_ids[1:], start=2) if uid}
+
+    def _set_agg_formula(self, user_id):
+        """Point a user's DailyAgg row at the SUMIF over their worksheet"""
+        formula = f"=SUMIF('{user_id}'!A:A,$B$1&\"*\",'{user_id}'!B:B)"
+        row = self._agg_rows.get(str(user_id))
+        if row is not None:
+            self.agg_sheet.update(
+                f'A{row}:B{row}', [[user_id, formula]],
+                value_input_option='USER_ENTERED')
+            return
+        # Let Sheets pick the row so other workers or hand edits can never
+        # hand the same row to two users; INSERT_ROWS grows the sheet past
+        # the rows it was created with
+        response = self.agg_sheet.append_row(
+            [user_id, formula], value_input_option='USER_ENTERED',
+            insert_data_option='INSERT_ROWS', table_range='A1')
+        updated_range = response['updates']['updatedRange']
+        self._agg_rows[str(user_id)] = int(
+            _RANGE_ROW_RE.search(updated_range).group(1))
+
+    def _user_sheet(self, user_id):
+        """Return the worksheet holding one user's transactions, creating it on first use"""
+        user_id = str(user_id)
+        worksheet = self._user_sheets.get(user_id)
+        created = False
+        if worksheet is None:
+            try:
+                worksheet = self.spreadsheet.worksheet(user_id)
+            except gspread.WorksheetNotFound:
+                worksheet = self.spreadsheet.add_worksheet(
+                    user_id, rows=USER_SHEET_ROWS, cols=len(USER_SHEET_HEADERS))
+                worksheet.update('A1', [USER_SHEET_HEADERS])
+                worksheet.format('B:B', AMOUNT_FORMAT)
+                created = True
+                logger.info(f"✅ Created sheet for user {user_id}")
+        # Users tracked before per-user sheets existed have a formula over
+        # the shared sheet; repoint it when their own sheet is created. A
+        # reload of the DailyAgg rows can also drop a user whose sheet is
+        # already cached
+        if created or user_id not in self._agg_rows:
+            self._set_agg_formula(user_id)
+        self._user_sheets[user_id] = worksheet
+        return worksheet
 
-    def parse_rupiah_amount(self, amount_value):
-        """Parse Rupiah formatted string to float - SIMPLIFIED and FIXED"""
+    def record_transaction(self, amount, description, user_id, username):
+        """Count a transaction in today's total and return (user_id, sheet row)
+
+        The row is written later by add_transactions; until then its amount
+        is tracked as pending so a cache reload does not drop it.
+        """
+        # Amount is a whole-rupiah column; a hidden fraction would still be
+        # added up by the DailyAgg SUMIF
+        amount = round(amount)
+        now = datetime.now()
+        key = (str(user_id), now.strftime('%Y-%m-%d'))
+        with self._cache_lock:
+            self._daily_totals[key] = self._daily_totals.get(key, 0) + amount
+            self._pending[key] = self._pending.get(key, 0) + amount
+        logger.info(f"✅ Queued: Rp{amount:,.0f} - {description}")
+        # RAW keeps Amount a real number; Rupiah display is a cell format
+        return user_id, [
+            now.strftime('%Y-%m-%d %H:%M:%S'),
+            amount,
+            description,
+            username
+        ]
+
+    def add_transactions(self, transactions):
+        """Append (user_id, row) pairs to Google Sheets in one request
+
+        Returns the transactions that could not be written, so the caller
+        can retry them; a 429 quota error is raised instead. Afterwards the
+        affected users' DailyAgg totals are read back to correct the cache.
+        """
+        by_user = {}
+        for user_id, row in transactions:
+            by_user.setdefault(str(user_id), []).append(row)
         try:
-            # If it's already a number, return it
-            if isinstance(amount_value, (int, float)):
-                return float(amount_value)
-            # If it's a string, parse Rupiah format
-            if isinstance(amount_value, str):
-                logger.info(f"🔍 Parsing Rupiah amount: '{amount_value}'")
-                # Remove "Rp" prefix and any whitespace
-                cleaned = amount_value.replace('Rp', '').strip()
-                # Remove ALL dots and commas (thousands separators in Indonesian format)
-                # In Indonesian: 1.000.000 means 1000000 (one million)
-                # We remove ALL special characters and parse as integer
-                cleaned = cleaned.replace('.', '').replace(',', '')
-                # Remove any remaining non-numeric characters
-                cleaned = re.sub(r'[^\d]', '', cleaned)
-                # Parse to float
-                result = float(cleaned) if cleaned else 0.0
-                logger.info(f"✅ Parsed '{amount_value}' -> {result}")
-                return result
-            return 0.0
-        except (ValueError, TypeError) as e:
-            logger.error(f"❌ Error parsing amount '{amount_value}': {e}")
-            return 0.0
+            # All users' rows go out in a single spreadsheets.batchUpdate.
+            # appendCells lets Sheets pick the next empty row, so other
+            # workers or rows typed by hand are never overwritten
+            append_requests = [{
+                'appendCells': {
+                    'sheetId': self._user_sheet(user_id).id,
+                    'rows': [{'values': [_cell(value) for value in row]}
+                             for row in rows],
+                    'fields': 'userEnteredValue',
+                }
+            } for user_id, rows in by_user.items()]
+            self.spreadsheet.batch_update({'requests': append_requests})
+        except gspread.exceptions.APIError as e:
+            status = e.response.status_code
+            if status == 429:
+                # Left to the caller's quota backoff; nothing is stale
+                raise
+            logger.error(f"❌ Error adding transactions: {e}")
+            if status in (400, 404):
+                # A deleted or renamed sheet fails every retry with the
+                # cached handle; look the sheets and DailyAgg rows up again
+                for user_id in by_user:
+                    self._user_sheets.pop(user_id, None)
+                try:
+                    self._load_agg_rows()
+                except Exception as e:
+                    logger.error(
+                        f"❌ Error reloading {DAILY_AGG_SHEET} rows: {e}")
+            return transactions
+        except Exception as e:
+            logger.error(f"❌ Error adding transactions: {e}")
+            return transactions
+        with self._cache_lock:
+            for user_id, rows in by_user.items():
+                for row in rows:
+                    key = (user_id, row[0].split(' ')[0])
+                    self._pending[key] = self._pending.get(key, 0) - row[1]
+                    if self._pending[key] <= 0:
+                        del self._pending[key]
+        logger.info(f"✅ Added {len(transactions)} transactions")
+        try:
+            self._sync_daily_totals(list(by_user))
+        except Exception as e:
+            # The rows are saved; the cache catches up on the next reload
+            logger.error(f"❌ Error syncing daily totals: {e}")
+        return []
+
+    def _sync_daily_totals(self, user_ids):
+        """Refresh the cached totals of users whose rows were just written"""
+        today = date.today().strftime('%Y-%m-%d')
+        if self._agg_date != today:
+            return
+        known = [user_id for user_id in user_ids if user_id in self._agg_rows]
+        # A user without a DailyAgg row is re-added below like a moved one
+        moved = len(known) < len(user_ids)
+        response = {'valueRanges': []}
+        if known:
+            response = self.spreadsheet.values_batch_get(
+                [f"{DAILY_AGG_SHEET}!A{self._agg_rows[user_id]}:B{self._agg_rows[user_id]}"
+                 for user_id in known],
+                params={'valueRenderOption': 'UNFORMATTED_VALUE'})
+        with self._cache_lock:
+            for user_id, value_range in zip(known, response['valueRanges']):
+                row = (value_range.get('values') or [[]])[0]
+                if len(row) < 2 or str(row[0]) != user_id:
+                    # The row no longer belongs to this user; never show
+                    # someone else's total
+                    moved = True
+                    continue
+                if not isinstance(row[1], (int, float)):
+                    continue
+                key = (user_id, today)
+                self._daily_totals[key] = row[1] + self._pending.get(key, 0)
+        if moved:
+            self._load_agg_rows()
+            for user_id in user_ids:
+                if user_id not in self._agg_rows:
+                    self._set_agg_formula(user_id)
+
+    def _load_daily_totals(self):
+        """Rebuild the per-user daily totals cache from the DailyAgg sheet"""
+        today = date.today().strftime('%Y-%m-%d')
+        rows = self.agg_sheet.get(
+            'A1:B', value_render_option='UNFORMATTED_VALUE')
+        if not rows or len(rows[0]) < 2 or rows[0][1] != today:
+            # Point every formula at today's date; the sheet's own TODAY()
+            # may be in a different timezone than the bot
+            self.agg_sheet.update('B1', [[today]], value_input_option='RAW')
+            rows = self.agg_sheet.get(
+                'A1:B', value_render_option='UNFORMATTED_VALUE')
+        self._agg_date = today
+        totals = {}
+        for record_user, amount, *_ in (row for row in rows[1:] if len(row) >= 2):
+            if isinstance(amount, (int, float)) and amount:
+                totals[(str(record_user), today)] = amount
+        with self._cache_lock:
+            for key, amount in self._pending.items():
+                totals[key] = totals.get(key, 0) + amount
+            self._daily_totals = totals
+            self._cache_loaded_at = time.time()
+        logger.info(f"📈 Daily totals loaded for {len(totals)} users")
+
+    def refresh_daily_totals(self):
+        """Reload the daily totals cache once it is older than CACHE_TTL"""
+        with self._cache_lock:
+            if time.time() - self._cache_loaded_at <= CACHE_TTL:
+                return
+            # Claim the reload up front so concurrent replies share one read
+            # and a failed read is not retried before the next TTL
+            self._cache_loaded_at = time.time()
+        self._load_daily_totals()
 
     def get_daily_total(self, user_id):
-        """Calculate today's total spending - FIXED for Rupiah formatting"""
+        """Return today's total spending from the in-memory cache"""
+        today = date.today().strftime('%Y-%m-%d')
+        with self._cache_lock:
+            daily_total = self._daily_totals.get((str(user_id), today), 0)
+        logger.info(f"📈 Daily total: Rp{daily_total:,.0f}")
+        return round(daily_total, 2)
+
+
+# Initialized by connect_sheets() so importing this module makes no API calls
+tracker = None
+sheets_connected = False
+
+
+def connect_sheets():
+    """Initialize the tracker on first use and report whether it is connected"""
+    global tracker, sheets_connected
+    if tracker is None:
         try:
-            records = self.sheet.get_all_records()
-            today = date.today().strftime('%Y-%m-%d')
-            daily_total = 0
-            transaction_count = 0
-            for record in records:
-                if 'Date' in record and 'Amount' in record:
-                    record_date = record['Date'].split(' ')[0] if ' ' in str(
-                        record['Date']) else str(record['Date'])
-                    record_user = record.get('UserID', '')
-                    if record_date == today and str(user_id) in str(record_user):
-                        # Use the new Rupiah parsing method
-                        raw_amount = record['Amount']
-                        amount = self.parse_rupiah_amount(raw_amount)
-                        daily_total += amount
-                        transaction_count += 1
-                        logger.info(
-                            f"💰 Transaction {transaction_count}: '{raw_amount}' -> {amount}")
-            logger.info(
-                f"📈 Daily total calculated: Rp{daily_total:,.0f} from {transaction_count} transactions")
-            return round(daily_total, 2)
+            tracker = GoogleSheetsFinanceTracker()
+            sheets_connected = True
         except Exception as e:
-            logger.error(f"❌ Error calculating daily total: {e}")
-            return 0
+            logger.error(f"❌ Failed to connect to Google Sheets: {e}")
+            sheets_connected = False
+    return sheets_connected
 
 
-# Initialize tracker
-try:
-    tracker = GoogleSheetsFinanceTracker()
-    sheets_connected = True
-except Exception as e:
-    logger.error(f"❌ Failed to connect to Google Sheets: {e}")
-    sheets_connected = False
+# Rows waiting to be written and the limit on concurrent Sheets calls;
+# created in post_init on the bot's event loop
+transaction_queue = None
+sheets_semaphore = None
+# Transactions taken off the queue but not written yet, the lock held while
+# they are being written and the task writing them; post_shutdown uses all
+# three so a stopping bot neither loses nor double-writes a batch
+unwritten = []
+flush_lock = None
+flush_task = None
 
 
 def parse_flexible_message(message):
@@ -182,49 +418,20 @@ def parse_flexible_message(message):
         'jt': 1000000,  # Indonesian: juta
         'b': 1000000000,
     }
-    # FIXED: Look for multipliers FIRST, then numbers
-    # This handles cases like "2rb", "2jt", etc.
-    # Pattern to find number with potential multiplier (including multi-character)
-    # This will match: "2rb", "2 rb", "2jt", "2 jt", "2k", "2 k", etc.
-    number_pattern = r'(\d+\.?\d*)\s*([a-z]{1,2})'
-    match = re.search(number_pattern, message)
+    match = _NUM_MULT_RE.search(message)
     if match:
-        amount_str = match.group(1)
-        multiplier_str = match.group(2).lower()
-        try:
-            amount = float(amount_str)
-            if multiplier_str in multipliers:
-                amount *= multipliers[multiplier_str]
-
-            # Remove the matched pattern to get description
-            description = re.sub(number_pattern, '', message, count=1).strip()
-            description = re.sub(r'\s+', ' ', description).strip()
-            if not description:
-                description = "miscellaneous"
-            logger.info(
-                f"✅ Parsed '{message}' -> {amount} with multiplier '{multiplier_str}'")
-            return amount, description
-        except ValueError:
-            pass
-    # Fallback: try without multiplier (just number and description)
-    parts = message.split(' ', 1)
-    if len(parts) == 2:
-        try:
-            # Try first part as number
-            amount = float(parts[0])
-            description = parts[1].strip()
-            logger.info(f"✅ Parsed '{message}' -> {amount} (no multiplier)")
-            return amount, description
-        except ValueError:
-            try:
-                # Try second part as number
-                amount = float(parts[1])
-                description = parts[0].strip()
-                logger.info(
-                    f"✅ Parsed '{message}' -> {amount} (no multiplier, reversed)")
-                return amount, description
-            except ValueError:
-                pass
+        amount = float(match.group(1))
+        multiplier_str = match.group(2) or match.group(3)
+        if multiplier_str:
+            amount *= multipliers[multiplier_str]
+        # Remove the matched pattern to get description
+        description = _NUM_MULT_RE.sub('', message, count=1).strip()
+        description = _WS_RE.sub(' ', description).strip()
+        if not description:
+            description = "miscellaneous"
+        logger.info(
+            f"✅ Parsed '{message}' -> {amount} with multiplier '{multiplier_str}'")
+        return amount, description
     logger.info(f"❌ Could not parse message: '{message}'")
     return None, None
 
@@ -254,11 +461,16 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
     try:
-        success = tracker.add_transaction(
+        transaction = tracker.record_transaction(
             amount, description, user_id, username)
-        if not success:
-            await update.message.reply_text("❌ Error menyimpan ke Google Sheets.")
-            return
+        await transaction_queue.put(transaction)
+        try:
+            # A single attempt: a reply never waits out quota backoff, and
+            # a failed reload is next tried after CACHE_TTL
+            await sheets_call(tracker.refresh_daily_totals, retries=1)
+        except Exception as e:
+            # Answer from the cached total rather than failing the reply
+            logger.error(f"❌ Error refreshing daily totals: {e}")
         daily_total = tracker.get_daily_total(user_id)
         # Format response with Indonesian Rupiah
         response = (
@@ -294,12 +506,197 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
-def main():
-    """Start the bot"""
-    if not sheets_connected:
+def is_rate_limited(error):
+    """Whether a Sheets API error is a 429 quota response"""
+    return (isinstance(error, gspread.exceptions.APIError)
+            and error.response.status_code == 429)
+
+
+async def sheets_call(func, *args, retries=SHEETS_MAX_RETRIES):
+    """Run a blocking Sheets call in a worker thread, retrying on 429"""
+    for attempt in range(retries):
+        try:
+            async with sheets_semaphore:
+                return await asyncio.to_thread(func, *args)
+        except gspread.exceptions.APIError as e:
+            if not is_rate_limited(e) or attempt == retries - 1:
+                raise
+            logger.warning(
+                f"⏳ Sheets quota hit, retrying in {2 ** attempt}s")
+            # Back off without holding a slot other calls could use
+            await asyncio.sleep(2 ** attempt)
+
+
+async def drain_queue(queue, batch, max_items, timeout):
+    """Move queued items into batch: wait for the first, then collect more for up to timeout seconds"""
+    batch.append(await queue.get())
+    deadline = asyncio.get_running_loop().time() + timeout
+    while len(batch) < max_items:
+        remaining = deadline - asyncio.get_running_loop().time()
+        if remaining <= 0:
+            break
+        try:
+            batch.append(await asyncio.wait_for(queue.get(), remaining))
+        except asyncio.TimeoutError:
+            break
+
+
+async def add_transactions_per_user(transactions):
+    """Write each user's transactions separately so one failing user cannot block the rest"""
+    by_user = {}
+    for transaction in transactions:
+        by_user.setdefault(str(transaction[0]), []).append(transaction)
+    failed = []
+    for user_transactions in by_user.values():
+        try:
+            failed += await sheets_call(
+                tracker.add_transactions, user_transactions)
+        except Exception as e:
+            logger.error(f"❌ Error adding transactions: {e}")
+            failed += user_transactions
+    return failed
+
+
+async def flush_transactions():
+    """Background task writing queued transactions to Google Sheets"""
+    failures = 0
+    while True:
+        if not unwritten:
+            await drain_queue(
+                transaction_queue, unwritten, BATCH_MAX_ROWS, BATCH_INTERVAL)
+        elif failures >= SPLIT_AFTER_FAILURES:
+            # Keep taking new rows while a failing user's rows are retried
+            while not transaction_queue.empty():
+                unwritten.append(transaction_queue.get_nowait())
+        async with flush_lock:
+            try:
+                if failures < SPLIT_AFTER_FAILURES:
+                    unwritten[:] = await sheets_call(
+                        tracker.add_transactions, list(unwritten))
+                else:
+                    unwritten[:] = await add_transactions_per_user(
+                        list(unwritten))
+            except Exception as e:
+                # Still over quota after every retry; keep the whole batch
+                logger.error(f"❌ Error adding transactions: {e}")
+        if unwritten:
+            # Retry the unwritten part of the batch before taking new rows,
+            # backing off so a quota error does not turn into a retry storm
+            failures += 1
+            await asyncio.sleep(min(2 ** failures, MAX_BACKOFF))
+        else:
+            failures = 0
+
+
+async def post_init(application: Application):
+    """Create the transaction queue and start the batch writer"""
+    global transaction_queue, sheets_semaphore, flush_lock, flush_task
+    transaction_queue = asyncio.Queue()
+    sheets_semaphore = asyncio.Semaphore(SHEETS_CONCURRENCY)
+    flush_lock = asyncio.Lock()
+    # A plain task rather than application.create_task, which stop() would
+    # wait on forever; stop_batch_writer stops it instead
+    flush_task = asyncio.create_task(flush_transactions())
+
+
+async def stop_batch_writer():
+    """Stop the batch writer and move the queue into unwritten"""
+    if flush_task is not None:
+        # Holding the lock means no batch is in flight while cancelling
+        async with flush_lock:
+            flush_task.cancel()
+        try:
+            await flush_task
+        except asyncio.CancelledError:
+            pass
+    while transaction_queue is not None and not transaction_queue.empty():
+        unwritten.append(transaction_queue.get_nowait())
+
+
+def save_unwritten():
+    """Write the transactions left by a stopped batch writer in this thread
+
+    Used at interpreter exit, where asyncio.to_thread can no longer start
+    worker threads.
+    """
+    if not unwritten:
+        return
+    try:
+        unwritten[:] = tracker.add_transactions(list(unwritten))
+    except Exception as e:
+        logger.error(f"❌ Error adding transactions: {e}")
+    if unwritten:
+        logger.error(
+            f"❌ {len(unwritten)} transactions could not be saved on shutdown")
+
+
+async def post_shutdown(application: Application):
+    """Stop the batch writer and write everything it had not written yet"""
+    await stop_batch_writer()
+    if unwritten:
+        try:
+            unwritten[:] = await sheets_call(
+                tracker.add_transactions, list(unwritten))
+        except Exception as e:
+            logger.error(f"❌ Error adding transactions: {e}")
+        if unwritten:
+            logger.error(
+                f"❌ {len(unwritten)} transactions could not be saved on shutdown")
+
+
+def build_application():
+    """Create the Telegram application with all handlers registered"""
+    connect_sheets()
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
+    # Add handlers
+    application.add_handler(MessageHandler(
+        filters.TEXT & ~filters.COMMAND, handle_message))
+    application.add_handler(MessageHandler(
+        filters.Regex(r'^/start'), start_command))
+    return application
+
+
+async def start_webhook(application: Application):
+    """Start processing updates pushed to the webhook instead of polling"""
+    if not connect_sheets():
+        raise RuntimeError("Google Sheets connection failed")
+    await application.initialize()
+    await post_init(application)
+    await application.start()
+    await application.bot.set_webhook(
+        url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET)
+    logger.info(f"🤖 Webhook registered: {WEBHOOK_URL}")
+
+
+async def stop_webhook(application: Application):
+    """Stop a bot started by start_webhook
+
+    Its remaining transactions are left in unwritten for the caller to
+    write with save_unwritten once the loop is done with them.
+    """
+    if application.running:
+        await application.stop()
+    await stop_batch_writer()
+    await application.shutdown()
+
+
+def main(**polling_kwargs):
+    """Start the bot
+
+    Keyword arguments go to run_polling; app.py passes stop_signals=None
+    because signal handlers can only be installed in the main thread.
+    """
+    if not connect_sheets():
         logger.error("❌ Cannot start bot: Google Sheets connection failed")
         print("❌ Failed to connect to Google Sheets. Please check your configuration.")
-        return
+        # Raise so app.py's restart loop tries to connect again
+        raise RuntimeError("Google Sheets connection failed")
     # Check if BOT_TOKEN is set
     if BOT_TOKEN == 'YOUR_BOT_TOKEN_HERE':
         logger.error(
@@ -307,22 +704,18 @@ def main():
         print("❌ Error: BOT_TOKEN not set. Please set the environment variable.")
         return
     try:
-        application = Application.builder().token(BOT_TOKEN).build()
-        # Add handlers
-        application.add_handler(MessageHandler(
-            filters.TEXT & ~filters.COMMAND, handle_message))
-        application.add_handler(MessageHandler(
-            filters.Regex(r'^/start'), start_command))
+        application = build_application()
         logger.info("🤖 Finance Tracker Bot is starting...")
         print("✅ Bot is running with Google Sheets!")
         print(f"📊 Using spreadsheet: {SPREADSHEET_NAME}")
         print("💰 Support for Indonesian Rupiah currency enabled")
         print("🔧 Fixed Rupiah comma parsing and multiplier handling")
         print("Press Ctrl+C to stop")
-        application.run_polling()
+        application.run_polling(**polling_kwargs)
     except Exception as e:
         logger.error(f"❌ Failed to start bot: {e}")
         print(f"❌ Error starting bot: {e}")
+        raise
 
 
 if __name__ == "__main__":